@@ -1,6 +1,10 @@
 """input_features_dai 模块输入 SQL, 可用于因子和特征抽取、数据标注等"""
 
+import functools
+import itertools
+import os
 import re
+import threading
 import uuid
 from collections import OrderedDict
 
@@ -95,9 +99,11 @@ DEFAULT_EXPR_FILTERS = """-- DAI SQL 算子/函数: https://bigquant.com/wiki/do
 -- cn_stock_bar1d.turn > 0.02
 """
 
-# 去除单引号内的内容字符串: instrument in ('jm2201.DCE') 避免抽取出 jm2201
-REMOVE_STRING_RE = re.compile(r"'[^']*'")
+# 去除单引号内的内容字符串: instrument in ('jm2201.DCE') 避免抽取出 jm2201, 不跨行匹配
+REMOVE_STRING_RE = re.compile(r"'[^'\n]*'")
 TABLE_NAME_RE = re.compile(r"(?<!\.)\b[a-zA-Z_]\w*\b(?=\.[a-zA-Z_*])")
+# 数据输入 input_1/2/3 的引用, 一次扫描完成全部替换
+INPUT_NAME_RE = re.compile(r"\binput_[123]\b")
 
 EXPR_SQL_TEMPLATE = """
 SELECT
@@ -108,24 +114,67 @@ FROM {tables}
 """
 
 
-def _ds_to_table(ds) -> dict:
+def _reset_table_id():
+    # 输入表名: 进程内计数器生成, 前缀带 pid 和一次性随机串, 避免与缓存结果(其他进程生成)里的表名冲突
+    global _table_id_prefix, _table_id_counter
+    _table_id_prefix = f"_t_{os.getpid():x}_{uuid.uuid4().hex[:8]}_"
+    _table_id_counter = itertools.count()
+
+
+_reset_table_id()
+# fork 出的子进程需要新的前缀
+os.register_at_fork(after_in_child=_reset_table_id)
+
+
+@functools.cache
+def _dai():
+    """延迟导入 dai, 只在需要查询或写数据时导入"""
+    import dai
+
+    return dai
+
+
+def _reset_bigdb():
+    # bigdb 连接按线程复用; fork 出的子进程不能沿用父进程的连接
+    global _bigdb_local
+    _bigdb_local = threading.local()
+
+
+_reset_bigdb()
+os.register_at_fork(after_in_child=_reset_bigdb)
+
+
+def _bigdb():
+    """当前线程的 bigdb 连接, 首次使用时创建, 之后复用"""
+    conn = getattr(_bigdb_local, "conn", None)
+    if conn is None:
+        import bigdb
+
+        conn = _bigdb_local.conn = bigdb.connect()
+    return conn
+
+
+def _ds_to_table(ds, create_table=True) -> dict:
     if isinstance(ds, str):
         sql = ds
     else:
         type_ = ds.type
         if type_ == "json":
             sql = ds.read()["sql"]
-        elif type == "text":
+        elif type_ == "text":
             sql = ds.read()
         else:
             # bdb
             return {"sql": "", "table_id": ds.id}
 
-    import bigdb
-
-    table_id = f"_t_{uuid.uuid4().hex}"
-    parts = [x.strip().strip(";") for x in bigdb.connect().parse_query(sql)]
-    parts[-1] = f"CREATE TABLE {table_id} AS {parts[-1]}"
+    parts = [x.strip().strip(";") for x in _bigdb().parse_query(sql)]
+    if create_table:
+        table_id = f"{_table_id_prefix}{next(_table_id_counter):x}"
+        parts[-1] = f"CREATE TABLE {table_id} AS {parts[-1]}"
+    else:
+        # 只保留前置语句 (e.g. CREATE MACRO), 不为最后的查询创建表
+        table_id = None
+        parts = parts[:-1]
     sql = ";\n".join(parts)
     if sql:
         sql += ";\n"
@@ -136,66 +185,86 @@ def _ds_to_table(ds) -> dict:
     }
 
 
-def _ds_to_tables(inputs) -> dict:
-    sql = ""
+def _ds_to_tables(inputs, used_names=None) -> dict:
+    # used_names: 被引用到的输入 (e.g. {"input_1"}), None 表示全部。未引用的输入不创建表, 只保留其前置语句, table_id 为 None
     tables = []
-    input_tables = []
     for i, x in enumerate(inputs):
         if x is None:
             continue
-        table = _ds_to_table(x)
-        table["name"] = f"input_{i+1}"
+        name = f"input_{i+1}"
+        create_table = used_names is None or name in used_names
+        if not create_table:
+            logger.info(f"{name} is not referenced, skip creating its table")
+        table = _ds_to_table(x, create_table=create_table)
+        table["name"] = name
         tables.append(table)
 
     return {
         "items": tables,
-        "map": {x["name"]: x for x in tables},
-        "sql": "".join([x["sql"] for x in tables]),
     }
 
 
+def _replace_input_names(sql: str, input_map: dict) -> str:
+    """替换 sql 里的 input_* 为对应的 table_id, input_map: {name: table_id}"""
+    if not input_map:
+        return sql
+    return INPUT_NAME_RE.sub(lambda m: input_map.get(m.group(0), m.group(0)), sql)
+
+
 def _split_expr(expr):
     lines = []
     for line in expr.splitlines():
         line = line.strip()
-        if not line:
-            continue
-        if line.startswith("--") or line.startswith("#"):
-            continue
-        lines.append(line)
+        # 跳过空行和 -- / # 开头的注释行
+        if line and not line.startswith(("--", "#")):
+            lines.append(line)
 
     return lines
 
 
 def _build_sql_from_expr(expr: str, expr_filters: str, default_tables="", order_by="", expr_drop_na=True, input_tables={}):
+    # input_tables 转为可 hash 的 ((name, table_id), ...), 以便缓存生成的 SQL
+    input_ids = tuple((x["name"], x["table_id"]) for x in input_tables["items"])
+    return _build_sql_from_expr_cached(expr, expr_filters, default_tables, order_by, expr_drop_na, input_ids)
+
+
+@functools.lru_cache(maxsize=256)
+def _build_sql_from_expr_cached(expr: str, expr_filters: str, default_tables: str, order_by: str, expr_drop_na: bool, input_ids: tuple):
     expr_lines = _split_expr(expr)
     filter_lines = _split_expr(expr_filters)
-
-    # collect all tables, join them
-    tables = [x.strip() for x in default_tables.split(";") if x.strip()] + [x["table_id"] for x in input_tables["items"]]
-    for line in expr_lines + filter_lines:
-        tables += TABLE_NAME_RE.findall(REMOVE_STRING_RE.sub('', line))
-    # de-dup and add using primary key
-    join_usings = {}
-    table_set = set()
-    table_list = []
-    for x in tables:
-        if " USING(" in x:
-            s = x.split(" ", 1)
-            # input_* table
-            if s[0] in input_tables["map"]:
-                s[0] = input_tables["map"][s[0]]["table_id"]
-            join_usings[s[0]] = s[1]
-            x = s[0]
-        if x in input_tables["map"]:
-            x = input_tables["map"][x]["table_id"]
-        # TODO: process x is input_*
-        if x not in table_set:
-            table_list.append(x)
-        table_set.add(x)
-    for i in range(1, len(table_list)):
-        table_list[i] += " " + join_usings.get(table_list[i], "USING(date, instrument)").strip()
-    tables = "\n    JOIN ".join(table_list)
+    input_map = dict(input_ids)
+
+    # collect all tables (de-dup, keep order), join them
+    tables = dict.fromkeys(
+        itertools.chain(
+            (x.strip() for x in default_tables.split(";") if x.strip()),
+            (table_id for _, table_id in input_ids),
+            # 所有行拼接后一次抽取, 每行的结果与逐行抽取相同
+            TABLE_NAME_RE.findall(REMOVE_STRING_RE.sub("", "\n".join(expr_lines + filter_lines))),
+        )
+    )
+    if len(tables) == 1 and not input_map and " USING(" not in next(iter(tables)):
+        # 常见情况: 只有一个默认表 (e.g. cn_stock_prefactors), 不需要 join
+        tables = next(iter(tables))
+    else:
+        # map input_* and add using primary key
+        join_usings = {}
+        joined = {}
+        for x in tables:
+            if " USING(" in x:
+                s = x.split(" ", 1)
+                # input_* table
+                if s[0] in input_map:
+                    s[0] = input_map[s[0]]
+                join_usings[s[0]] = s[1]
+                x = s[0]
+            if x in input_map:
+                x = input_map[x]
+            joined[x] = None
+        table_list = list(joined)
+        for i in range(1, len(table_list)):
+            table_list[i] += " " + join_usings.get(table_list[i], "USING(date, instrument)").strip()
+        tables = "\n    JOIN ".join(table_list)
 
     # 构建过滤添加，放到 QUALIFY 里
     if expr_drop_na:
@@ -210,11 +279,12 @@ def _build_sql_from_expr(expr: str, expr_filters: str, default_tables="", order_
 
     sql = EXPR_SQL_TEMPLATE.format(expr=",\n    ".join(expr_lines), tables=tables, qualify=qualify, order_by=order_by)
 
-    return sql
+    # 表达式/过滤/排序里的 input_* 在这里一并替换, 结果随 SQL 一起缓存
+    return _replace_input_names(sql, input_map)
 
 
 def _create_ds_from_sql(sql: str, extract_data: bool, base_ds=None):
-    import dai
+    dai = _dai()
 
     if extract_data:
         logger.info("extract data ..")
@@ -261,9 +331,9 @@ def run(
 ) -> [I.port("输出(SQL文件)", "data")]:
     """输入特征（因子）数据"""
 
-    input_tables = _ds_to_tables([input_1, input_2, input_3])
+    inputs = [input_1, input_2, input_3]
 
-    if "；" in expr_tables:
+    if not expr_tables.isascii() and "；" in expr_tables:
         logger.warning("检测到中文分号在 表达式-默认数据表 参数中，请使用英文分号。已自动替换，下次使用时请注意，否则可能导致意外的错误。")
         expr_tables = expr_tables.replace("；", ";")
 
@@ -278,6 +348,8 @@ def run(
         if expr_filters is None:
             expr_filters = ""
 
+        # 表达式模式会自动 join 所有输入
+        input_tables = _ds_to_tables(inputs)
         final_sql = _build_sql_from_expr(
             expr + "\n" + extra_fields.replace(",", "\n"), expr_filters, expr_tables, order_by=order_by, expr_drop_na=expr_drop_na, input_tables=input_tables
         )
@@ -289,13 +361,13 @@ def run(
             logger.error("sql 模式下， SQL特征输入为空！")
             raise
 
-        final_sql = sql
-
-    # 替换 input_*
-    for x in input_tables["items"]:
-        final_sql = re.sub(rf'\b{x["name"]}\b', x["table_id"], final_sql)
+        # SQL 模式只为 SQL 里引用到的输入创建表
+        input_tables = _ds_to_tables(inputs, used_names=set(INPUT_NAME_RE.findall(sql)))
+        # 替换 input_*, 表达式模式在生成 SQL 时已经替换
+        final_sql = _replace_input_names(sql, {x["name"]: x["table_id"] for x in input_tables["items"] if x["table_id"]})
 
-    final_sql = input_tables["sql"] + final_sql
+    # 输入表的 CREATE TABLE 语句 + 主 SQL, 最后一次性拼接
+    final_sql = "".join([x["sql"] for x in input_tables["items"]] + [final_sql])
 
     # 使用第一个input ds的 extra
     return I.Outputs(data=_create_ds_from_sql(final_sql, extract_data, input_1))